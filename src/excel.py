@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import requests
 import threading
+from enum import Enum
 from dotenv import load_dotenv
 from .auth import get_access_token
 
@@ -12,6 +14,19 @@ load_dotenv()
 EXCEL_WORKSHEET_NAME = os.getenv("EXCEL_WORKSHEET_NAME")
 USER_ID = os.getenv("USER_ID")
 
+# Leituras de intervalo trazem apenas os valores (sem formulas, text, numberFormat...)
+RANGE_VALUES_ONLY = {"$select": "values"}
+
+# Número com pontos agrupando milhares e sem parte decimal, ex.: "1.234.567"
+_THOUSANDS_DOTS = re.compile(r"\d{1,3}(\.\d{3})+")
+
+class OperationResult(str, Enum):
+    """
+    Resultado de uma operação registrado na coluna C.
+    """
+    WIN = "W"
+    LOSS = "L"
+
 # Cache simples para o ID do arquivo
 _file_id_cache = None
 _file_id_lock = threading.Lock()
@@ -19,6 +34,11 @@ _file_id_lock = threading.Lock()
 # Lock para operações concorrentes de escrita/limpeza
 _excel_write_lock = threading.Lock()
 
+# Posição da última linha escrita na coluna C (None = desconhecida, ex.: após reiniciar).
+# É memória do processo: o Procfile fixa um único worker, e o /undo ainda confere a posição na planilha.
+_last_written_row = None
+_last_row_lock = threading.Lock()
+
 def get_cached_file_id():
     """
     Obtém o ID do arquivo Excel, usando cache para evitar chamadas repetidas.
@@ -105,71 +125,104 @@ def update_cell(cell, value):
         print(f"[Excel] Célula {cell} atualizada com sucesso")
         return True
 
-def get_cell_value(cell):
+def parse_number(raw_value, default=0.0):
     """
-    Obtém o valor de uma célula, tratando erros e convertendo para float.
-    Retorna 0.0 em caso de erro ou valor não numérico.
+    Converte um valor bruto lido da planilha para float.
+    Trata números, strings em formato BRL ("R$ 1.234,56", "-R$ 5,00", "(R$ 5,00)")
+    e erros de fórmula (#N/A, #VALUE!...).
+    Retorna default para valores vazios, erros ou não numéricos.
     """
-    token = get_access_token()
-    file_id = get_cached_file_id() # Usa cache
-
-    if not token or not file_id:
-        print(f"[Excel] ERRO: Não foi possível ler célula {cell}. Token ou file_id inválidos.")
-        return 0.0 # Retorna 0.0 em caso de erro de setup
-
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
-
-    url = f"https://graph.microsoft.com/v1.0/users/{USER_ID}/drive/items/{file_id}/workbook/worksheets/{EXCEL_WORKSHEET_NAME}/range(address=\'{cell}\')"
-
-    print(f"[Excel] Lendo valor da célula {cell}")
-    try:
-        response = requests.get(url, headers=headers, timeout=15) # Adicionado timeout
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"[Excel] ERRO: Falha na requisição ao ler célula {cell}: {e}")
-        print(f"[Excel] Resposta (se disponível): {response.text if 'response' in locals() else 'N/A'}")
-        return 0.0 # Retorna 0.0 em caso de erro de API
-
-    values = response.json().get("values", [[None]])
-    raw_value = values[0][0]
-    print(f"[Excel] Valor bruto lido da célula {cell}: {repr(raw_value)}")
-
-    # Tratar valor lido
     if raw_value is None:
-        print(f"[Excel] Célula {cell} está vazia, retornando 0.0")
-        return 0.0
+        return default
 
     if isinstance(raw_value, (int, float)):
-        print(f"[Excel] Valor numérico {raw_value} lido da célula {cell}")
         return float(raw_value)
 
     if isinstance(raw_value, str):
-        # Handle specific Excel errors like #VALUE!, #N/A, etc.
-        if raw_value.startswith("#"):
-            print(f"[Excel] Aviso: Erro de fórmula \'{raw_value}\' lido da célula {cell}, retornando 0.0")
-            return 0.0
+        text = raw_value.strip()
+
+        # Strings vazias e erros de fórmula do Excel
+        if not text or text.startswith("#"):
+            return default
+
+        # Extrai o sinal antes de remover R$ e espaços: "-R$ 5,00", "R$ -5,00" e "(R$ 5,00)"
+        negative = False
+        if text.startswith("(") and text.endswith(")"):
+            negative = True
+            text = text[1:-1].strip()
+        if text.startswith("-"):
+            negative = not negative
+            text = text[1:]
+        text = text.replace("R$", "").replace(" ", "").replace("\xa0", "")
+        if text.startswith("-"):
+            negative = not negative
+            text = text[1:]
+
+        # Pontos só são separadores de milhar com vírgula decimal ou em grupos de três ("1.234")
+        if "," in text:
+            text = text.replace(".", "").replace(",", ".")
+        elif _THOUSANDS_DOTS.fullmatch(text):
+            text = text.replace(".", "")
 
-        # Try converting string to float (handle potential commas, currency symbols)
         try:
-            # Remove R$, spaces, thousands separators (.), then replace comma decimal separator
-            cleaned_value = raw_value.replace("R$", "").strip().replace(".", "").replace(",", ".")
-            numeric_value = float(cleaned_value)
-            print(f"[Excel] Valor string \'{raw_value}\' convertido para float {numeric_value} da célula {cell}")
-            return numeric_value
+            value = float(text)
+        except ValueError:
+            return default
+        return -value if negative else value
+
+    return default
+
+def parse_result(raw_value):
+    """
+    Converte um valor bruto da coluna C para OperationResult (None se vazio ou inválido).
+    """
+    if isinstance(raw_value, str):
+        try:
+            return OperationResult(raw_value.strip().upper())
         except ValueError:
-            print(f"[Excel] Aviso: Valor não numérico \'{raw_value}\' lido da célula {cell}, retornando 0.0")
-            return 0.0
+            return None
+    return None
+
+def parse_history_block(values, start_row):
+    """
+    Converte um bloco 2-D B:E (número, resultado, entrada, lucro) em colunas tipadas.
+    Para na primeira linha sem número de operação, pois o histórico é contíguo.
+    """
+    columns = {"linha": [], "numero": [], "resultado": [], "valor": [], "lucro": []}
+
+    for i, row_data in enumerate(values):
+        # Completa linhas curtas para sempre ter as 4 colunas
+        numero, resultado, valor, lucro = (list(row_data) + [None] * 4)[:4]
+        if numero is None or str(numero).strip() == "":
+            break
+
+        columns["linha"].append(start_row + i)
+        columns["numero"].append(numero)
+        columns["resultado"].append(parse_result(resultado))
+        columns["valor"].append(parse_number(valor, None))
+        columns["lucro"].append(parse_number(lucro, None))
+
+    return columns
+
+def get_cell_value(cell):
+    """
+    Obtém o valor de uma célula, tratando erros e convertendo para float.
+    Retorna 0.0 em caso de erro ou valor não numérico.
+    """
+    values = get_range_values(cell)
+    if not values or not values[0]:
+        print(f"[Excel] Não foi possível ler a célula {cell}, retornando 0.0")
+        return 0.0
 
-    # Fallback for unexpected types
-    print(f"[Excel] Aviso: Tipo de valor inesperado ({type(raw_value)}) lido da célula {cell}, retornando 0.0")
-    return 0.0
+    raw_value = values[0][0]
+    numeric_value = parse_number(raw_value)
+    print(f"[Excel] Valor da célula {cell}: {repr(raw_value)} -> {numeric_value}")
+    return numeric_value
 
 def get_range_values(cell_range):
     """
     Obtém valores de um intervalo de células.
+    Pede apenas a propriedade "values" ao Graph, evitando formulas, text, numberFormat etc.
     """
     token = get_access_token()
     file_id = get_cached_file_id() # Usa cache
@@ -187,7 +240,7 @@ def get_range_values(cell_range):
 
     print(f"[Excel] Lendo valores do intervalo {cell_range}")
     try:
-        response = requests.get(url, headers=headers, timeout=15) # Adicionado timeout
+        response = requests.get(url, headers=headers, params=RANGE_VALUES_ONLY, timeout=15) # Adicionado timeout
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"[Excel] ERRO: Falha na requisição ao ler intervalo {cell_range}: {e}")
@@ -198,39 +251,141 @@ def get_range_values(cell_range):
     print(f"[Excel] {len(values)} linhas lidas do intervalo {cell_range}")
     return values
 
+def _is_empty_cell(row_data):
+    """
+    Considera a linha vazia se a célula na coluna estiver vazia ou for None.
+    """
+    return not row_data or row_data[0] is None or str(row_data[0]).strip() == ""
+
+def _count_filled_rows(column, start_row, end_row):
+    """
+    Conta as linhas preenchidas contíguas a partir de start_row em uma coluna.
+    Retorna None em caso de erro na leitura.
+    """
+    range_values = get_range_values(f"{column}{start_row}:{column}{end_row}")
+
+    if range_values is None: # Erro ao ler o intervalo
+        return None
+
+    filled = 0
+    for row_data in range_values:
+        if _is_empty_cell(row_data):
+            break
+        filled += 1
+    return filled
+
 def find_next_empty_row(column, start_row, end_row):
     """
     Encontra o número da próxima linha vazia em uma coluna.
     """
     print(f"[Excel] Procurando próxima linha vazia na coluna {column} ({start_row}-{end_row})")
-    range_values = get_range_values(f"{column}{start_row}:{column}{end_row}")
+    filled = _count_filled_rows(column, start_row, end_row)
 
-    if range_values is None: # Erro ao ler o intervalo
+    if filled is None:
         print(f"[Excel] ERRO: Falha ao ler intervalo para encontrar linha vazia.")
         return None
 
-    if not range_values: # Intervalo completamente vazio
-        print(f"[Excel] Intervalo {column}{start_row}:{column}{end_row} vazio, retornando linha inicial {start_row}")
-        return start_row
+    next_row_num = start_row + filled
+    if next_row_num > end_row:
+        # Todas as linhas no intervalo estão preenchidas
+        print(f"[Excel] Nenhuma linha vazia encontrada no intervalo {column}{start_row}:{column}{end_row}. Verifique se o intervalo é suficiente.")
+        return None
 
-    for i, row_data in enumerate(range_values):
-        # Considera a linha vazia se a célula na coluna estiver vazia ou for None
-        if not row_data or row_data[0] is None or str(row_data[0]).strip() == "":
-            next_row_num = start_row + i
-            print(f"[Excel] Próxima linha vazia encontrada: {next_row_num}")
-            return next_row_num
+    print(f"[Excel] Próxima linha vazia encontrada: {next_row_num}")
+    return next_row_num
 
-    # Se chegou aqui, todas as linhas no intervalo estão preenchidas
-    print(f"[Excel] Nenhuma linha vazia encontrada no intervalo {column}{start_row}:{column}{end_row}. Verifique se o intervalo é suficiente.")
-    return None
+def find_last_filled_row(column, start_row, end_row):
+    """
+    Encontra o número da última linha preenchida (contígua) em uma coluna.
+    Retorna start_row - 1 se a coluna estiver vazia, ou None em caso de erro.
+    """
+    print(f"[Excel] Procurando última linha preenchida na coluna {column} ({start_row}-{end_row})")
+    filled = _count_filled_rows(column, start_row, end_row)
+
+    if filled is None:
+        print(f"[Excel] ERRO: Falha ao ler intervalo para encontrar última linha preenchida.")
+        return None
+
+    last_row = start_row + filled - 1
+    print(f"[Excel] Última linha preenchida: {last_row}")
+    return last_row
+
+def _is_last_filled_row(column, row_num, start_row, end_row):
+    """
+    Confirma, lendo no máximo duas células, que row_num é a última linha preenchida
+    (row_num preenchida e a seguinte vazia). Para row_num < start_row, confirma que
+    a coluna está vazia. Retorna False em caso de erro na leitura.
+    """
+    if row_num < start_row:
+        values = get_range_values(f"{column}{start_row}")
+        return values is not None and _is_empty_cell(values[0] if values else None)
+
+    if row_num > end_row:
+        return False
+
+    last = min(row_num + 1, end_row)
+    values = get_range_values(f"{column}{row_num}:{column}{last}")
+    if not values or _is_empty_cell(values[0]):
+        return False
+    return last == row_num or len(values) < 2 or _is_empty_cell(values[1])
 
 def write_operation(row_num, result):
     """
     Escreve o resultado (W/L) na linha especificada da coluna C.
     Assume que os valores de entrada (B, D, E) são calculados pela planilha.
     """
+    global _last_written_row
     print(f"[Excel] Escrevendo operação '{result}' na linha {row_num}")
-    return update_cell(f"C{row_num}", result)
+    with _last_row_lock:
+        if not update_cell(f"C{row_num}", result):
+            # A escrita pode ter sido aplicada mesmo com erro (ex.: timeout); força nova leitura no /undo
+            _last_written_row = None
+            return False
+        _last_written_row = row_num
+    return True
+
+def undo_last_operation(start_row=3, end_row=102):
+    """
+    Desfaz a última operação limpando apenas a última linha escrita na coluna C.
+    Usa a posição rastreada da última escrita, confirmada com a leitura de até duas células;
+    se ela for desconhecida ou estiver desatualizada (outro worker, edição manual), lê a coluna.
+    Retorna (sucesso, linha): linha é None quando não há operação para desfazer.
+    """
+    global _last_written_row
+    with _last_row_lock:
+        row_num = _last_written_row
+        if row_num is not None and not _is_last_filled_row("C", row_num, start_row, end_row):
+            print(f"[Excel] Posição rastreada (linha {row_num}) desatualizada, lendo coluna C")
+            row_num = None
+
+        if row_num is None:
+            if _last_written_row is None:
+                print("[Excel] Posição da última linha desconhecida, lendo coluna C")
+            row_num = find_last_filled_row("C", start_row, end_row)
+            if row_num is None:
+                _last_written_row = None
+                return False, None
+        _last_written_row = row_num
+
+        if row_num < start_row:
+            print("[Excel] Nenhuma operação para desfazer")
+            return True, None
+
+        print(f"[Excel] Desfazendo operação da linha {row_num}")
+        if not update_cell(f"C{row_num}", ""):
+            _last_written_row = None
+            return False, row_num
+
+        _last_written_row = row_num - 1
+        return True, row_num
+
+def mark_operations_cleared(start_row=3):
+    """
+    Registra que a coluna C foi limpa (ex.: após /reset), sem necessidade de nova leitura.
+    """
+    global _last_written_row
+    with _last_row_lock:
+        _last_written_row = start_row - 1
 
 def clear_range(cell_range):
     """
@@ -298,34 +453,27 @@ def get_history_data(max_rows=100):
     end_row = start_row + max_rows - 1
     print(f"[Excel] Obtendo dados do histórico (Linhas {start_row}-{end_row})")
 
-    # Ler colunas necessárias em lote (idealmente seria uma única chamada batch)
-    numeros = get_range_values(f"B{start_row}:B{end_row}")
-    resultados = get_range_values(f"C{start_row}:C{end_row}")
-    entradas = get_range_values(f"D{start_row}:D{end_row}")
-    lucros = get_range_values(f"E{start_row}:E{end_row}")
+    # Ler as colunas B:E em uma única chamada e converter o bloco de uma vez
+    values = get_range_values(f"B{start_row}:E{end_row}")
 
-    if numeros is None or resultados is None or entradas is None or lucros is None:
-        print("[Excel] ERRO: Falha ao ler um ou mais intervalos do histórico")
+    if values is None:
+        print("[Excel] ERRO: Falha ao ler o intervalo do histórico")
         return [] # Retorna lista vazia em caso de erro
 
     # Formatar histórico
-    historico = []
-    num_items = min(len(numeros), len(resultados), len(entradas), len(lucros))
-
-    for i in range(num_items):
-        # Só adiciona ao histórico se o número da operação (coluna B) existir e não for vazio
-        num_op = numeros[i][0] if numeros[i] else None
-        if num_op is not None and str(num_op).strip() != "":
-            historico.append({
-                "numero": num_op,
-                "valor": entradas[i][0] if entradas[i] else None,
-                "resultado": resultados[i][0] if resultados[i] else None,
-                "lucro": lucros[i][0] if lucros[i] else None
-            })
-        else:
-            # Para de adicionar ao encontrar a primeira linha sem número de operação
-            # Assume que o histórico é contíguo
-            break
+    columns = parse_history_block(values, start_row)
+    historico = [
+        {
+            "linha": linha,
+            "numero": numero,
+            "valor": valor,
+            "resultado": resultado.value if resultado else None,
+            "lucro": lucro
+        }
+        for linha, numero, resultado, valor, lucro in zip(
+            columns["linha"], columns["numero"], columns["resultado"], columns["valor"], columns["lucro"]
+        )
+    ]
 
     print(f"[Excel] {len(historico)} itens de histórico formatados")
     return historico
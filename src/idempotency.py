@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, jsonify
+
+# Configurações do cache de idempotência
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+IDEMPOTENCY_TTL = 600  # segundos
+IDEMPOTENCY_MAX_ENTRIES = 256
+
+# Marcador para chaves cuja requisição original ainda está em andamento
+_PENDING = object()
+
+# Cache limitado: (rota, chave) -> (expira_em, payload, status)
+# Fica na memória do processo, então só deduplica com um único worker (ver Procfile)
+_idempotency_cache = OrderedDict()
+_idempotency_lock = threading.Lock()
+
+def _purge_expired(current_time):
+    """
+    Remove entradas expiradas e as mais antigas que excedem o limite.
+    Deve ser chamada com o lock adquirido.
+    """
+    for cache_key in [k for k, entry in _idempotency_cache.items() if entry[0] <= current_time]:
+        del _idempotency_cache[cache_key]
+
+    while len(_idempotency_cache) > IDEMPOTENCY_MAX_ENTRIES:
+        _idempotency_cache.popitem(last=False)
+
+def idempotent(view):
+    """
+    Decorador que deduplica requisições com o cabeçalho Idempotency-Key.
+    Uma requisição repetida com a mesma chave recebe a resposta original sem
+    executar a rota novamente (e sem acessar a planilha).
+    Respostas com erro de servidor (5xx) não são armazenadas, para permitir nova tentativa.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        if not key:
+            return view(*args, **kwargs)
+
+        cache_key = (request.path, key)
+        current_time = time.time()
+
+        with _idempotency_lock:
+            _purge_expired(current_time)
+            entry = _idempotency_cache.get(cache_key)
+            if entry is not None:
+                if entry[1] is _PENDING:
+                    print(f"[Idempotency] Requisição com chave '{key}' ainda em andamento em {request.path}")
+                    return jsonify({"status": "error", "message": "Requisição com esta Idempotency-Key ainda em andamento"}), 409
+                print(f"[Idempotency] Retornando resposta armazenada para chave '{key}' em {request.path}")
+                return jsonify(entry[1]), entry[2]
+            _idempotency_cache[cache_key] = (current_time + IDEMPOTENCY_TTL, _PENDING, None)
+
+        response, status = None, 500
+        try:
+            response, status = view(*args, **kwargs)
+            return response, status
+        finally:
+            with _idempotency_lock:
+                if response is not None and status < 500:
+                    _idempotency_cache[cache_key] = (time.time() + IDEMPOTENCY_TTL, response.get_json(), status)
+                    _idempotency_cache.move_to_end(cache_key)
+                    _purge_expired(time.time())
+                else:
+                    _idempotency_cache.pop(cache_key, None)
+
+    return wrapper
@@ -11,8 +11,12 @@ from .excel import (
     check_connection,
     get_summary_data,
     get_history_data,
-    write_operation
+    write_operation,
+    OperationResult,
+    undo_last_operation,
+    mark_operations_cleared
 )
+from .idempotency import idempotent
 
 # Carregar variáveis de ambiente
 load_dotenv()
@@ -81,6 +85,7 @@ def create_app():
 
     # Endpoint para registrar vitória (WIN)
     @app.route('/win', methods=['POST'])
+    @idempotent
     def win():
         try:
             print("[API] Recebido pedido para registrar vitória")
@@ -91,7 +96,7 @@ def create_app():
                 return jsonify({"status": "error", "message": "Não há células vazias disponíveis"}), 400
             
             print(f"[API] Registrando vitória na célula C{next_row}")
-            if write_operation(next_row, "W"):
+            if write_operation(next_row, OperationResult.WIN.value):
                 print(f"[API] Vitória registrada com sucesso na célula C{next_row}")
                 
                 # Obter dados atualizados após registrar a vitória
@@ -114,6 +119,7 @@ def create_app():
 
     # Endpoint para registrar derrota (LOSS)
     @app.route('/loss', methods=['POST'])
+    @idempotent
     def loss():
         try:
             print("[API] Recebido pedido para registrar derrota")
@@ -124,7 +130,7 @@ def create_app():
                 return jsonify({"status": "error", "message": "Não há células vazias disponíveis"}), 400
             
             print(f"[API] Registrando derrota na célula C{next_row}")
-            if write_operation(next_row, "L"):
+            if write_operation(next_row, OperationResult.LOSS.value):
                 print(f"[API] Derrota registrada com sucesso na célula C{next_row}")
                 
                 # Obter dados atualizados após registrar a derrota
@@ -145,6 +151,39 @@ def create_app():
             print(f"[API] Exceção ao processar /loss: {str(e)}")
             return jsonify({"status": "error", "message": f"Erro ao registrar derrota: {str(e)}"}), 500
 
+    # Endpoint para desfazer a última operação (WIN/LOSS)
+    @app.route('/undo', methods=['POST'])
+    @idempotent
+    def undo():
+        try:
+            print("[API] Recebido pedido para desfazer última operação")
+            success, row_num = undo_last_operation(3, 102)
+            
+            if not success:
+                print("[API] Erro ao desfazer última operação")
+                return jsonify({"status": "error", "message": "Erro ao desfazer última operação"}), 500
+            
+            if row_num is None:
+                print("[API] Nenhuma operação para desfazer")
+                return jsonify({"status": "error", "message": "Nenhuma operação para desfazer"}), 400
+            
+            print(f"[API] Operação da célula C{row_num} desfeita com sucesso")
+            
+            # Obter dados atualizados após desfazer
+            summary_data = get_summary_data()
+            history_data = get_history_data(10)  # Limitar a 10 itens mais recentes
+            
+            # Retornar todos os dados necessários para atualizar o frontend
+            return jsonify({
+                "status": "success", 
+                "message": f"Operação da célula C{row_num} desfeita",
+                **summary_data,
+                "historico": history_data
+            }), 200
+        except Exception as e:
+            print(f"[API] Exceção ao processar /undo: {str(e)}")
+            return jsonify({"status": "error", "message": f"Erro ao desfazer operação: {str(e)}"}), 500
+
     # Endpoint para zerar (limpar células)
     @app.route('/reset', methods=['POST'])
     def reset():
@@ -155,6 +194,7 @@ def create_app():
             if not clear_range("C3:C102"):
                 print("[API] Erro ao limpar resultados")
                 return jsonify({"status": "error", "message": "Erro ao limpar resultados"}), 500
+            mark_operations_cleared(3)
             
             # Limpar células de entrada
             cell_mapping = {